@@ -4,6 +4,7 @@ STATION_ID = "<Your Station ID>"
 # I2C pins
 SCL_PIN = 22   # D22
 SDA_PIN = 21   # D21
+I2C_FREQ = 100000  # hardware I2C bus frequency, AM2320 is limited to 100 kHz (400 kHz without it)
 
 # Error led pin
 LED_PIN = 2    # onboard led
@@ -32,7 +33,9 @@ OPENWEATHERMAP_API = "<Your OpenWeather API key>"
 OPENWEATHERMAP_CITY = "<Your OpenWeather City\,2-letter landcode"  # escape comma with backslash
 OPENWEATHERMAP_LAT = "<Your OpenWeather City latitude>"      
 OPENWEATHERMAP_LON = "<Your OpenWeather City longitude>"      
-OPENWEATHERMAP_URL = "https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api}"
+OPENWEATHERMAP_URL = "http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api}"  # plain http, no TLS handshake
+OPENWEATHERMAP_CACHE_AGE = 1800  # reuse OpenWeather data kept in RTC memory for max 30 minutes (seconds)
+OPENWEATHERMAP_CACHE_HITS = 1    # max number of cycles the cached OpenWeather data is reused
 
 # MQTT variables
 MQTT_HOST = "<IP address MQTT host>"
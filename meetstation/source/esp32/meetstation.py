@@ -31,17 +31,38 @@
 # Libraries
 ####################################################################################
 
-from machine import Pin, SoftI2C, ADC, deepsleep, reset
+from machine import Pin, I2C, ADC, RTC, deepsleep, reset
 import config
-import network
 import utime
-import json
+import ustruct
 import sys
-import urequests
-from umqtt.simple import MQTTClient
-from am2320 import AM2320
-from bmp180 import BMP180
-from bh1750 import BH1750
+import gc
+import math
+# network, urequests, json, umqtt and the sensor drivers are imported in the functions that use them
+
+####################################################################################
+# Objects created once at startup
+####################################################################################
+
+# OpenWeather webhook url
+OW_URL = config.OPENWEATHERMAP_URL.format(lat=config.OPENWEATHERMAP_LAT, lon=config.OPENWEATHERMAP_LON, api=config.OPENWEATHERMAP_API)
+
+# error led pin object (led off)
+LED = Pin(config.LED_PIN, Pin.OUT, value=config.LED_OFF)
+
+# debug pin object
+DEBUG = Pin(config.DEBUG_PIN, Pin.IN, Pin.PULL_UP)
+
+# battery voltage adc object
+VBAT_ADC = ADC(Pin(config.VBAT_PIN))
+VBAT_ADC.atten(ADC.ATTN_11DB)  # range 0-3.3V
+
+# MQTT payload template for influxdb_v2 with the constant tags filled in
+# <measurement>[,<tag_key>=<tag_value>[,<tag_key>=<tag_value>]] <field_key>=<field_value>[,<field_key>=<field_value>] [<timestamp>]
+# field values are rounded to the sensor resolution to keep the payload small
+PAYLOAD_FMT = ('forecasts,source=OpenWeatherMap,location={city} ow_temp=%.1f,ow_hum=%.0f,ow_pres=%.0f\n'
+               'actuals,source={station},location={city} ac_temp=%.1f,ac_hum=%.1f,ac_pres=%.1f,ac_lum=%.1f,ac_batv=%.2f,ac_rssi=%d'
+               ).format(city=config.OPENWEATHERMAP_CITY, station=config.STATION_ID)
 
 ####################################################################################
 # Error routine
@@ -50,14 +71,11 @@ from bh1750 import BH1750
 def show_error():
     ''' visual display of error condition - flashing onboard LED '''
     
-    # led pin object
-    led = Pin(config.LED_PIN, Pin.OUT)
-    
     # flash 3 times
     for i in range(3):
-        led.value(config.LED_ON)
+        LED.value(config.LED_ON)
         utime.sleep(0.5)
-        led.value(config.LED_OFF)
+        LED.value(config.LED_OFF)
         utime.sleep(0.5)
     
 
@@ -68,11 +86,8 @@ def show_error():
 def debug_on():
     ''' check if debugging is on - debug pin LOW '''
     
-    # debug pin object
-    debug = Pin(config.DEBUG_PIN, Pin.IN, Pin.PULL_UP)
-    
     # check debug pin
-    if debug.value() == 0:
+    if DEBUG.value() == 0:
         # print('Debug mode detected.')
         return True
     
@@ -84,7 +99,10 @@ def debug_on():
 ####################################################################################
 
 def connect_wifi():
-    ''' connect the µcontroller to the local wifi network '''
+    ''' start connecting the µcontroller to the local wifi network.
+        the connection is set up in the background, use wait_wifi() to wait for it '''
+    
+    import network
     
     # disable AP mode of µcontroller
     ap_if = network.WLAN(network.AP_IF)
@@ -102,77 +120,152 @@ def connect_wifi():
         # activate wifi station
         sta_if.active(True)
         
-        # try to connect to the wifi network
+        # disable wifi power saving during the short awake time (not on older firmware)
+        if hasattr(sta_if, 'PM_NONE'):
+            sta_if.config(pm=sta_if.PM_NONE)
+        
+        # start connecting to the wifi network
         sta_if.connect(config.SSID, config.PASS)  
         
-        # keep trying for a number of times
-        tries = 0
-        while not sta_if.isconnected() and tries < config.MAX_TRIES:  
-            
-            # show progress
-            print('.', end='')
-            
-            # wait
-            utime.sleep(1)
-            
-            # update counter
-            tries += 1
+    return sta_if
+
+
+####################################################################################
+# Wait for Wifi connection
+####################################################################################
+
+def wait_wifi(sta_if):
+    ''' wait until the µcontroller is connected to the local wifi network '''
+    
+    # keep trying for a number of times (MAX_TRIES seconds, checked every 250 ms)
+    tries = 0
+    while not sta_if.isconnected() and tries < config.MAX_TRIES * 4:  
+        
+        # wait
+        utime.sleep_ms(250)
+        
+        # update counter
+        tries += 1
 
     # show network status 
     if sta_if.isconnected():
-        print('')
         print('connected to {} network with ip address {}' .format(config.SSID, sta_if.ifconfig()[0]))
         # return WiFi signal strength (Received Signal Strength Indicator)
         return sta_if.status('rssi')
 
     else:
-        print('')
         print('no connection to {} network' .format(config.SSID))
         # no WiFi
         raise RuntimeError('WiFi connection failed')
         return 0
 
             
+####################################################################################
+# OpenWeather data cache in RTC memory (survives deepsleep)
+####################################################################################
+
+# cache layout : timestamp, temperature (centiKelvin), humidity, pressure, number of reuses
+OW_CACHE_FORMAT = '<IhhhB'
+
+def read_weather_cache():
+    ''' return the OpenWeather data (kelvin, humidity, pressure) cached in RTC memory
+        or None if there is no cache or it is too old or reused too often '''
+    
+    # RTC memory is empty after a power on or hard reset
+    cache = RTC().memory()
+    if len(cache) != ustruct.calcsize(OW_CACHE_FORMAT):
+        return None
+    
+    epoch, temp_ck, hum, pres, hits = ustruct.unpack(OW_CACHE_FORMAT, cache)
+    
+    # check age and number of reuses
+    age = utime.time() - epoch
+    if age < 0 or age >= config.OPENWEATHERMAP_CACHE_AGE or hits >= config.OPENWEATHERMAP_CACHE_HITS:
+        return None
+    
+    # count this reuse
+    RTC().memory(ustruct.pack(OW_CACHE_FORMAT, epoch, temp_ck, hum, pres, hits + 1))
+    
+    return temp_ck / 100, hum, pres
+
+
+def write_weather_cache(kelvin, hum, pres):
+    ''' store fresh OpenWeather data in RTC memory for the next cycles '''
+    
+    RTC().memory(ustruct.pack(OW_CACHE_FORMAT, utime.time(), round(kelvin * 100), round(hum), round(pres), 0))
+
+
 ####################################################################################
 # Get current weather data from OpenWeather.org
 ####################################################################################
 
 def get_weather_data():
-    ''' get current weather data from OpenWeather.org.
+    ''' get current weather data from OpenWeather.org or from the RTC memory cache.
         return results in dictionary with following data :
         - 'temp' : current/day temperature
         - 'hum' : humidity
         - 'pres' : pressure  '''
     
-    # debug message
-    print('Invoking OpenWeather URL webhook')
-    
-    # webhook url
-    url = config.OPENWEATHERMAP_URL.format(lat=config.OPENWEATHERMAP_LAT, lon=config.OPENWEATHERMAP_LON, api=config.OPENWEATHERMAP_API)
-    
-    # send GET request
-    response = urequests.get(url)
+    # reuse recent OpenWeather data from a previous cycle
+    cache = read_weather_cache()
     
-    # evaluate response
-    if response.status_code < 400:
-        print('Webhook OpenWeather URL success')
-
+    if cache:
+        
+        # debug message
+        print('Using cached OpenWeather data')
+        
+        ow_kelvin, ow_hum, ow_pres = cache
+        
     else:
-        print('Webhook OpenWeather URL failed')
-        raise RuntimeError('Webhook OpenWeather URL failed')
-    
-    # get the data in json format
-    today = response.json()
-    
-    # debug message
-    if debug_on():
-        print('OpenWeather URL data')
-        print(today)
+        
+        # debug message
+        print('Invoking OpenWeather URL webhook')
+        
+        import urequests
+        import json
+        
+        # send GET request
+        response = urequests.get(OW_URL)
+        
+        # evaluate response
+        if response.status_code < 400:
+            print('Webhook OpenWeather URL success')
 
-    # extract data from OpenWeather dictionary
-    ow_temp = temperature_2_unit(today['main']['temp'] - 273.15)  # openweather temperatures in Kelvin 
-    ow_hum = today['main']['humidity'] 
-    ow_pres = today['main']['pressure']
+        else:
+            print('Webhook OpenWeather URL failed')
+            response.close()
+            raise RuntimeError('Webhook OpenWeather URL failed')
+        
+        # get the raw data and free the socket
+        raw = response.text
+        response.close()
+        
+        # debug message
+        if debug_on():
+            print('OpenWeather URL data')
+            print(raw)
+
+        # only parse the flat "main" object : {"temp":...,"pressure":...,"humidity":...}
+        # search for the object itself, the weather[] entries also have a "main" key (e.g. "main":"Rain")
+        start = raw.find('"main":{')
+        if start < 0:
+            raise RuntimeError('No main data in OpenWeather response')
+        start += len('"main":')
+        main = json.loads(raw[start:raw.find('}', start) + 1])
+        
+        # extract data from OpenWeather main dictionary
+        ow_kelvin = main['temp']  # openweather temperatures in Kelvin
+        ow_hum = main['humidity'] 
+        ow_pres = main['pressure']
+        
+        # release the response data before garbage collection
+        del raw, main, response
+        
+        # keep data for the next cycles
+        write_weather_cache(ow_kelvin, ow_hum, ow_pres)
+    
+    # convert temperature
+    ow_temp = temperature_2_unit(ow_kelvin - 273.15)
     
     # debug message
     if debug_on():
@@ -185,13 +278,17 @@ def get_weather_data():
 ####################################################################################
 # Temperature in Celsium or Fahrenheit
 ####################################################################################
-def temperature_2_unit(celsius):
-    ''' convert the temperature in Celsius to Fahrenheit is necessary '''
-    
-    # convert if necessary
-    if config.FAHRENHEIT:
+
+# the temperature unit is fixed per boot, so pick the conversion once
+if config.FAHRENHEIT:
+    def temperature_2_unit(celsius):
+        ''' convert the temperature in Celsius to Fahrenheit '''
+        
         return celsius * 9 / 5 + 32
-    else:
+else:
+    def temperature_2_unit(celsius):
+        ''' temperature stays in Celsius '''
+        
         return celsius
     
 
@@ -202,11 +299,32 @@ def temperature_2_unit(celsius):
 def get_sensor_readings():
     ''' get readings from all sensors and return them in a dictionary '''
     
+    from am2320 import AM2320
+    from bmp180 import BMP180
+    from bh1750 import BH1750
+    
     # debug message
     print('Getting sensor readings')
     
-    # I2C object
-    i2c = SoftI2C(scl=Pin(config.SCL_PIN), sda=Pin(config.SDA_PIN), freq=100000)
+    # hardware I2C object
+    i2c = I2C(0, scl=Pin(config.SCL_PIN), sda=Pin(config.SDA_PIN), freq=config.I2C_FREQ)
+    
+    # scan the I2C bus once for all sensors
+    i2c.scan()  # first scan to wake up AM2320 sensor
+    devices = i2c.scan()
+    
+    ################################################################################
+    # BH1750 light sensor - start measurement
+    ################################################################################
+    
+    # check if BH1750 sensor is detected
+    if 35 not in devices:
+        raise RuntimeError('Cannot find BH1750 sensor')
+    
+    # start a one time low resolution measurement (4 lux), it integrates while the other sensors are read
+    bh1750 = BH1750(i2c)
+    bh1750.set_mode(BH1750.ONCE_LOWRES)
+    bh1750_start = utime.ticks_ms()
     
     ################################################################################
     # AM2320 temperature and humidity sensor
@@ -214,8 +332,7 @@ def get_sensor_readings():
     am2320 = AM2320(i2c)
     
     # check if AM2320 sensor is detected
-    i2c.scan()  # first scan to wake up sensor
-    if 92 not in i2c.scan():
+    if 92 not in devices:
         raise RuntimeError('Cannot find AM2320 sensor')
     
     # read AM2320 sensor
@@ -233,28 +350,33 @@ def get_sensor_readings():
     bmp180 = BMP180(i2c)
 
     # check if BMP180 sensor is detected
-    if 119 not in i2c.scan():
+    if 119 not in devices:
         raise RuntimeError('Cannot find BMP180 sensor')
 
     # read BMP180 sensor
     bmp180_temp = temperature_2_unit(bmp180.temperature)
     bmp180_pres = bmp180.pressure/100  # values in Pa, divide by 100 for hPa
-    bmp180_alt = bmp180.altitude
+    
+    # altitude from the pressure above, the driver's altitude property would read the pressure again
+    bmp180_alt = -7990.0 * math.log(bmp180_pres * 100 / bmp180.baseline) if bmp180_pres > 0 else 0.0
     
     if debug_on():
         print('BMP180      T: {:.0f} {} - P: {:.0f} hPa - A: {:.0f} m' .format(bmp180_temp, 'F' if config.FAHRENHEIT else 'C', bmp180_pres, bmp180_alt))
 
     ################################################################################
-    # BH1750 light sensor
+    # BH1750 light sensor - read measurement
     ################################################################################
-    bh1750 = BH1750(i2c)
     
-    # check if BH1750 sensor is detected
-    if 35 not in i2c.scan():
-        raise RuntimeError('Cannot find BH1750 sensor')
+    # wait for the end of the integration time (max 24 ms)
+    utime.sleep_ms(max(0, 24 - utime.ticks_diff(utime.ticks_ms(), bh1750_start)))
+    
+    # read BH1750 sensor (1.2 counts per lux)
+    data = i2c.readfrom(bh1750.addr, 2)
+    bh1750_lum = (data[0] << 8 | data[1]) / 1.2
     
-    # read BH1750 sensor
-    bh1750_lum = bh1750.luminance(BH1750.ONCE_HIRES_1)
+    # measure again in high resolution (1 lux) at dawn, dusk and night
+    if bh1750_lum < 10:
+        bh1750_lum = bh1750.luminance(BH1750.ONCE_HIRES_1)
     
     if debug_on():
         print('BH1750FVI   L: {:.0f} lux' .format(bh1750_lum))
@@ -262,12 +384,10 @@ def get_sensor_readings():
     ################################################################################
     # battery voltage reading
     ################################################################################
-    adc = ADC(Pin(config.VBAT_PIN))
-    adc.atten(ADC.ATTN_11DB)  # range 0-3.3V
-        
+    
     # read battery voltage (reduce battery voltage from max 4.2V to 3.3V with resistance divider 27k/100k)
-    # adc read_u16 returns 16bit value (0-65535)
-    bat_volt = 3.3 * 1.27 * (adc.read_u16() / 2**16)
+    # adc read_u16 returns 16bit value (0-65535), average 16 samples to reduce the adc noise
+    bat_volt = 3.3 * 1.27 * ((sum(VBAT_ADC.read_u16() for _ in range(16)) >> 4) / 2**16)
     
     if debug_on():
         print('Battery     V: {:.2f} Volt' .format(bat_volt))
@@ -282,6 +402,9 @@ def get_sensor_readings():
 def log_readings(ow_data, sensor_data, wifi_rssi):
     ''' upload sensor readings to MQTT broker '''
     
+    from umqtt.simple import MQTTClient
+    import usocket as socket
+    
     # debug message
     print('Upload readings to MQTT broker')
     
@@ -296,21 +419,25 @@ def log_readings(ow_data, sensor_data, wifi_rssi):
     ac_batv = sensor_data['bat_volt']
     ac_rssi = wifi_rssi
     
-    # construct the payload for influxdb_v2
-    # <measurement>[,<tag_key>=<tag_value>[,<tag_key>=<tag_value>]] <field_key>=<field_value>[,<field_key>=<field_value>] [<timestamp>]
-    payload = ''
-    payload += 'forecasts,source={},location={} ow_temp={},ow_hum={},ow_pres={} \r\n' .format('OpenWeatherMap', str(config.OPENWEATHERMAP_CITY), str(ow_temp), str(ow_hum), str(ow_pres))
-    payload += 'actuals,source={},location={} ac_temp={},ac_hum={},ac_pres={},ac_lum={},ac_batv={},ac_rssi={} \r\n' .format(config.STATION_ID, str(config.OPENWEATHERMAP_CITY), str(ac_temp), str(ac_hum), str(ac_pres), str(ac_lum), str(ac_batv), str(ac_rssi))
+    # construct the payload for influxdb_v2, both lines go out in a single publish
+    payload = (PAYLOAD_FMT % (ow_temp, ow_hum, ow_pres, ac_temp, ac_hum, ac_pres, ac_lum, ac_batv, ac_rssi)).encode()
    
     try:
-        # instantiate MQTT object
-        client = MQTTClient('effevees_weerstation', config.MQTT_HOST, user=config.MQTT_USER, password=config.MQTT_PASS, keepalive=30)
+        # instantiate MQTT object - no keepalive pings needed, we disconnect right after publishing
+        client = MQTTClient('effevees_weerstation', config.MQTT_HOST, user=config.MQTT_USER, password=config.MQTT_PASS, keepalive=0)
     
         # connect to MQTT broker
         client.connect()
         
-        # publish payload
-        client.publish(config.MQTT_TOPIC, payload)
+        # disable Nagle's algorithm, the publish goes out right away (not on all ports)
+        if hasattr(socket, 'TCP_NODELAY'):
+            try:
+                client.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        
+        # publish payload - fire and forget, no PUBACK round trip
+        client.publish(config.MQTT_TOPIC, payload, qos=0)
         
         # disconnect client
         client.disconnect()
@@ -321,7 +448,7 @@ def log_readings(ow_data, sensor_data, wifi_rssi):
         
     # debug message
     if debug_on():
-        print('MQTT publish : {}' .format(payload))
+        print('MQTT publish : {}' .format(payload.decode()))
     
 
 ####################################################################################
@@ -348,14 +475,23 @@ def run():
     
     try:
         
-        # connect to WiFi network
-        wifi_rssi = connect_wifi()
+        # start connecting to WiFi network
+        sta_if = connect_wifi()
+        
+        # get sensor readings while the WiFi connection is set up
+        sensor_data = get_sensor_readings()
+        
+        # free the sensor driver objects
+        gc.collect()
+        
+        # wait for WiFi network
+        wifi_rssi = wait_wifi(sta_if)
         
         # get OpenWeatherMap data
         ow_data = get_weather_data()
         
-        # get sensor readings
-        sensor_data = get_sensor_readings()
+        # free the http socket and buffers before MQTT opens its own socket
+        gc.collect()
         
         # upload readings to MQTT broker
         log_readings(ow_data, sensor_data, wifi_rssi)
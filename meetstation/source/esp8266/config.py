@@ -32,7 +32,7 @@ OPENWEATHERMAP_API = "<Your OpenWeather API key>"
 OPENWEATHERMAP_CITY = "<Your OpenWeather City\,2-letter landcode"  # escape comma with backslash
 OPENWEATHERMAP_LAT = "<Your OpenWeather City latitude>"      
 OPENWEATHERMAP_LON = "<Your OpenWeather City longitude>"      
-OPENWEATHERMAP_URL = "https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api}"
+OPENWEATHERMAP_URL = "http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api}"  # plain http, no TLS handshake
 
 # MQTT variables
 MQTT_HOST = "<IP address MQTT host>"